@@ -1,100 +1,147 @@
 #!/usr/bin/env python3
 
+import csv
 import json
 import re
-from typing import List, Dict, Any
-import pandas as pd
+from typing import List, Dict, Any, Iterator, Tuple
 import argparse
-from phs2dd import main as phs2dd
-from tdr2dd import main as tdr2dd
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+_SANITIZE_RE = re.compile(r'[^\w\-]')
+_TDR_RE = re.compile(r'/snapshots/([0-9a-f-]+)$')
+
+# Indexes larger than this are streamed with ijson (when installed) instead of loaded whole
+STREAM_THRESHOLD_BYTES = 64 * 1024 * 1024
+
+STUDY_RESULTS_COLUMNS = (
+    'study_name', 'dataset_name', 'tdr_id', 'phs_id', 'access_management',
+    'data_use', 'phenotype', 'species', 'pi_name'
+)
+
+def _dumps_json(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
 def load_duos_index(index_file_path: str) -> List[Dict[str, Any]]:
-    with open(index_file_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-    return data
+    with open(index_file_path, 'rb') as f:
+        raw = f.read()
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def iter_matching_studies(
+    index_file_path: str,
+    title_query: str
+) -> Iterator[Dict[str, Any]]:
+    query = title_query.casefold()
+    if ijson is None or os.path.getsize(index_file_path) <= STREAM_THRESHOLD_BYTES:
+        for study in load_duos_index(index_file_path):
+            if query in study.get("study", {}).get("studyName", "").casefold():
+                yield study
+        return
+
+    with open(index_file_path, 'rb') as f:
+        for study in ijson.items(f, 'item', use_float=True):
+            if query in study.get("study", {}).get("studyName", "").casefold():
+                yield study
 
 def search_studies_by_title(
     studies: List[Dict[str, Any]], 
     title_query: str
 ) -> List[Dict[str, Any]]:
-    pattern = re.compile(f".*{re.escape(title_query)}*", re.IGNORECASE)
+    query = title_query.casefold()
     matches = []
     for study in studies:
         study_title = study.get("study", {}).get("studyName", "")
-        if pattern.search(study_title):
+        if query in study_title.casefold():
             matches.append(study)
     return matches
 
 def extract_study_details(study_obj: Dict[str, Any]) -> Dict[str, Any]:
-    tdr_url = study_obj.get('url', '')
-    tdr_id = None
-    if 'snapshots/' in tdr_url:
-        tdr_id = tdr_url.split('snapshots/')[-1]
+    get = study_obj.get
+    tdr_url = get('url', '')
+    tdr_match = _TDR_RE.search(tdr_url)
+    tdr_id = tdr_match.group(1) if tdr_match else None
 
-    study_nested = study_obj.get('study', {})
+    study_get = (get('study') or {}).get
 
     details = {
-        "dataset_identifier": study_obj.get('datasetIdentifier', ''),
-        "dataset_name": study_obj.get('datasetName', ''),
+        "dataset_identifier": get('datasetIdentifier', ''),
+        "dataset_name": get('datasetName', ''),
         "tdr_url": tdr_url,
         "tdr_id": tdr_id,
-        "access_management": study_obj.get('accessManagement', ''),
-        "data_use": study_obj.get('dataUse', {}),
-        "study_name": study_nested.get('studyName', ''),
-        "study_description": study_nested.get('description', ''),
-        "phs_id": study_nested.get('phsId', ''),
-        "phenotype": study_nested.get('phenotype', ''),
-        "species": study_nested.get('species', ''),
-        "pi_name": study_nested.get('piName', ''),
-        "data_types": study_nested.get('dataTypes', []),
+        "access_management": get('accessManagement', ''),
+        "data_use": get('dataUse', {}),
+        "study_name": study_get('studyName', ''),
+        "study_description": study_get('description', ''),
+        "phs_id": study_get('phsId', ''),
+        "phenotype": study_get('phenotype', ''),
+        "species": study_get('species', ''),
+        "pi_name": study_get('piName', ''),
+        "data_types": study_get('dataTypes', []),
     }
     return details
 
+def _extract_for_csv(study_obj: Dict[str, Any]) -> Tuple[Any, ...]:
+    get = study_obj.get
+    tdr_match = _TDR_RE.search(get('url', ''))
+    study_get = (get('study') or {}).get
+    # Same order as STUDY_RESULTS_COLUMNS
+    return (
+        study_get('studyName', ''),
+        get('datasetName', ''),
+        tdr_match.group(1) if tdr_match else None,
+        study_get('phsId', ''),
+        get('accessManagement', ''),
+        _dumps_json(get('dataUse', {})),
+        study_get('phenotype', ''),
+        study_get('species', ''),
+        study_get('piName', ''),
+    )
+
 def sanitize_directory_name(name: str) -> str:
-    sanitized_name = re.sub(r'[^\w\-]', '_', name)
+    sanitized_name = _SANITIZE_RE.sub('_', name)
     return sanitized_name
 
 def main(index_file_path: str, user_query: str,enumeration_threshold):
-    all_studies = load_duos_index(index_file_path)
-    matching_studies = search_studies_by_title(all_studies, user_query)
-    print(f"Found {len(matching_studies)} matching studies for query '{user_query}'.")
-    
+    rows = []
     phs_id_list = []
     object_id_list = []
-    results = []
-    for st in matching_studies:
-        details = extract_study_details(st)
-        tdr_id = details["tdr_id"]
-        phs_id = details["phs_id"]
-        study_package = {"basic_info": details}
-        results.append(study_package)
-    
-    rows = []
-    for r in results:
-        rows.append({
-            'study_name': r['basic_info']['study_name'],
-            'dataset_name': r['basic_info']['dataset_name'],
-            'tdr_id': r['basic_info']['tdr_id'],
-            'phs_id': r['basic_info']['phs_id'],
-            'access_management': r['basic_info']['access_management'],
-            'data_use': json.dumps(r['basic_info']['data_use']),
-            'phenotype': r['basic_info']['phenotype'],
-            'species': r['basic_info']['species'],
-            'pi_name': r['basic_info']['pi_name']
-        })
-        phs_id_list.append(r['basic_info']['phs_id'])
-        object_id_list.append(r['basic_info']['tdr_id'])
-    
-    df = pd.DataFrame(rows)
+    for st in iter_matching_studies(index_file_path, user_query):
+        row = _extract_for_csv(st)
+        rows.append(row)
+        object_id_list.append(row[2])
+        phs_id_list.append(row[3])
+    # Drop empty and repeated ids so each study is only fetched once downstream
+    phs_id_list = [x for x in dict.fromkeys(phs_id_list) if x]
+    object_id_list = [x for x in dict.fromkeys(object_id_list) if x]
+    print(f"Found {len(rows)} matching studies for query '{user_query}'.")
+
     if rows:
-        study_name = rows[0]['study_name']
+        study_name = rows[0][0]
         sanitized_study_name = sanitize_directory_name(study_name)
         study_dir = f"query_results/{sanitized_study_name}"
         print(f"Saving results to directory: {study_dir}")
         os.makedirs(study_dir, exist_ok=True)
         filename = os.path.join(study_dir, 'study_results.csv')
-        df.to_csv(filename, index=False)
+        with open(filename, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(STUDY_RESULTS_COLUMNS)
+            writer.writerows(rows)
+        # Imported here so searching does not pay for pandas and the Google client libraries
+        from phs2dd import main as phs2dd
+        from tdr2dd import main as tdr2dd
         phs2dd(phs_id_list, study_dir)
         tdr2dd(object_id_list, study_dir, enumeration_threshold)
 
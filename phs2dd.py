@@ -1,11 +1,42 @@
 import requests
+from requests.adapters import HTTPAdapter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
+import re
 import argparse
-from bs4 import BeautifulSoup
 import csv
 import logging
 from lxml import etree
 
+# dbGaP serves plain autoindex listings, so the links can be pulled straight from the HTML
+_HREF_RE = re.compile(rb'href="([^"]+)"')
+
+# Compiled once and reused for every <variable> element
+_NAME = etree.XPath('string(name)', smart_strings=False)
+_DESCRIPTION = etree.XPath('string(description)', smart_strings=False)
+_TYPE = etree.XPath('string(type)', smart_strings=False)
+_UNIT = etree.XPath('string(unit)', smart_strings=False)
+_LOGICAL_MIN = etree.XPath('string(logical_min)', smart_strings=False)
+_LOGICAL_MAX = etree.XPath('string(logical_max)', smart_strings=False)
+_COMMENT = etree.XPath('string(comment)', smart_strings=False)
+_VALUES = etree.XPath('value')
+
+# Number of concurrent data dictionary downloads
+MAX_WORKERS = 16
+
+# Seconds to wait for dbGaP before giving up on a request
+REQUEST_TIMEOUT = 30
+
+# Shared session so TCP/TLS connections to dbGaP are reused across requests
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+# Fetch a dbGaP directory listing, giving up on a stalled server
+def get_listing_content(url):
+    return SESSION.get(url, timeout=REQUEST_TIMEOUT).content
+
 def configure_logging(study_dir):
     log_file = os.path.join(study_dir, 'phs2dd.log')
     logging.basicConfig(
@@ -17,10 +48,9 @@ def configure_logging(study_dir):
 
 def get_lastest_version(study_url, phs_id):
     try:
-        response = requests.get(study_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = soup.find_all('a')
-        versions = [link.get('href').strip('/') for link in links if link.get('href').startswith(phs_id)]
+        hrefs = _HREF_RE.findall(get_listing_content(study_url))
+        phs_prefix = phs_id.encode()
+        versions = [href.decode().strip('/') for href in hrefs if href.startswith(phs_prefix)]
         
         if not versions:
             logging.error(f"No data dictionaries found for PHS ID: {phs_id} at {study_url}")
@@ -34,93 +64,97 @@ def get_lastest_version(study_url, phs_id):
         print(f"An error occurred: {e}")
 
 def get_data_dict_str(pheno_var_sums_url):
-        response = requests.get(pheno_var_sums_url)
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        links = soup.find_all('a')
-        data_dicts = [link.get('href') for link in links if link.get('href').endswith('data_dict.xml')]
+        hrefs = _HREF_RE.findall(get_listing_content(pheno_var_sums_url))
+        data_dicts = [href.decode() for href in hrefs if href.endswith(b'data_dict.xml')]
         if data_dicts == []:
             logging.error(f"{pheno_var_sums_url}: No data_dict.xml found")
             
         return data_dicts
 
 
+def iter_variable_rows(xml_content):
+    # Stream <variable> elements instead of building the whole tree
+    for _, var in etree.iterparse(io.BytesIO(xml_content), events=("end",), tag="variable"):
+        coded_value_list = []
+        for val in _VALUES(var):
+            code = val.get("code", "")
+            val_text = val.text or ""
+            if code:
+                coded_value_list.append(f"{code}={val_text}")
+            else:
+                coded_value_list.append(val_text)
+
+        yield (
+            _NAME(var),
+            _DESCRIPTION(var),
+            _TYPE(var),
+            _LOGICAL_MIN(var),
+            _LOGICAL_MAX(var),
+            _UNIT(var),
+            "; ".join(coded_value_list),
+            _COMMENT(var),
+            var.get("id", "")
+        )
+
+        # Free the processed element and any siblings already written
+        var.clear()
+        while var.getprevious() is not None:
+            del var.getparent()[0]
+
+def save_data_dict_csv(url, csv_name, future):
+    # A failed download only skips its own data dictionary
+    try:
+        response = future.result()
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logging.error(f"An error occurred downloading {url}: {e}")
+        print(f"An error occurred downloading {url}: {e}")
+        return
+
+    with open(csv_name, mode="w", newline="", encoding="utf-8", buffering=1 << 20) as f:
+        writer = csv.writer(f)
+        writer.writerow([
+            "variable_name", 
+            "description", 
+            "type", 
+            "min", 
+            "max", 
+            "units", 
+            "enumerations", 
+            "comment",
+            "dbgap_id"
+        ])
+        writer.writerows(iter_variable_rows(response.content))
+
+    print(f"Saved CSV: {csv_name}")
+    logging.info(f"Saved CSV: {csv_name}")
+
 def convert_xml_urls_to_csv(xml_urls, study_dir):
     try:
         output_folder = os.path.join(study_dir, "dbgap_csvs")
-        
-        if not os.path.exists(output_folder):
-            os.makedirs(output_folder)
-
-        for url in xml_urls:
-            response = requests.get(url)
-            response.raise_for_status() 
-
-            root = etree.fromstring(response.content)
-
-            base_name = os.path.basename(url)
-            csv_name = os.path.join(output_folder, base_name.replace(".xml", ".csv"))
-
-            variables = root.findall(".//variable")
-
-            with open(csv_name, mode="w", newline="", encoding="utf-8") as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    "variable_name", 
-                    "description", 
-                    "type", 
-                    "min", 
-                    "max", 
-                    "units", 
-                    "enumerations", 
-                    "comment",
-                    "dbgap_id"
-                ])
-
-                for var in variables:
-                    var_id = var.get("id", "")
-                    name = var.findtext("name", default="")
-                    description = var.findtext("description", default="")
-                    var_type = var.findtext("type", default="")
-                    unit = var.findtext("unit", default="")
-                    logical_min = var.findtext("logical_min", default="")
-                    logical_max = var.findtext("logical_max", default="")
-                    
-                    coded_value_list = []
-                    for val in var.findall("value"):
-                        code = val.get("code", "")
-                        val_text = val.text or ""
-                        if code:
-                            coded_value_list.append(f"{code}={val_text}")
-                        else:
-                            coded_value_list.append(val_text)
-                    coded_values = "; ".join(coded_value_list)
-
-                    comment = var.findtext("comment", default="")
-
-                    writer.writerow([
-                        name, 
-                        description, 
-                        var_type, 
-                        logical_min, 
-                        logical_max, 
-                        unit, 
-                        coded_values,
-                        comment,
-                        var_id 
-                    ])
-
-            print(f"Saved CSV: {csv_name}")
-            logging.info(f"Saved CSV: {csv_name}")
-            
+        os.makedirs(output_folder, exist_ok=True)
+
         csv_names = [os.path.basename(url).replace('.xml', '.csv') for url in xml_urls]
+
+        # Download the data dictionaries concurrently, writing and releasing the oldest response before
+        # starting another so at most MAX_WORKERS XML bodies are held in memory
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pending = deque()
+            for url, csv_base_name in zip(xml_urls, csv_names):
+                csv_name = os.path.join(output_folder, csv_base_name)
+                pending.append((url, csv_name, executor.submit(SESSION.get, url, timeout=REQUEST_TIMEOUT)))
+                if len(pending) == MAX_WORKERS:
+                    save_data_dict_csv(*pending.popleft())
+            while pending:
+                save_data_dict_csv(*pending.popleft())
+            
         if csv_names:
             prefix = csv_names[0].split('.data_dict')[0] if '.data_dict' in csv_names[0] else ''
             if prefix:
                 new_folder = os.path.join(study_dir, prefix)
-                if os.path.exists(output_folder):
-                    os.rename(output_folder, new_folder)
-                    logging.info(f"Renamed output folder to: {new_folder}")
+                # output_folder was created above, so it can be renamed without checking
+                os.rename(output_folder, new_folder)
+                logging.info(f"Renamed output folder to: {new_folder}")
     
     except requests.exceptions.RequestException as e:
         logging.error(f"An error occurred: {e}")
@@ -3,21 +3,85 @@
 #############################################
 
 import data_repo_client
+from data_repo_client.rest import ApiException
 import google.auth
 import google.auth.transport.requests
 from google.cloud import bigquery
+try:
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
 import os
 import datetime
+import hashlib
 import pandas as pd
+try:
+    import pyarrow
+    import pyarrow.compute as pc
+except ImportError:
+    pyarrow = None
 import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 
 #############################################
 ## Functions
 #############################################
 
+# Arrow-backed strings make nunique/unique run in Arrow's compiled kernels (pandas 1.3+ with pyarrow installed)
+try:
+    STRING_DTYPE = pd.StringDtype("pyarrow")
+except (ImportError, TypeError):
+    STRING_DTYPE = str
+
+# Pandas dtypes used when reading TDR columns of each schema datatype
+TDR_PANDAS_DTYPES = {
+    "string": STRING_DTYPE,
+    "text": STRING_DTYPE,
+    "integer": "Int64",
+    "int64": "Int64",
+    "float": "float64",
+    "float64": "float64",
+    "numeric": "float64",
+    "boolean": "boolean",
+}
+
+# Schema fields used for columns that are not in the TDR schema
+DEFAULT_SCHEMA_FIELDS = ("Unknown", False, False, None)
+
+# Data dictionary type names for array columns of each schema datatype
+ARRAY_TYPES = {
+    "string": "array of strings",
+    "integer": "array of integers",
+    "float": "array of floats",
+    "boolean": "array of booleans",
+}
+
+# Enumerations that are fixed by the data dictionary type
+FIXED_ENUMERATIONS = {
+    "boolean": "T=True;F=False",
+}
+
+# Number of concurrent TDR requests
+TDR_MAX_WORKERS = 16
+
+# Number of concurrent BigQuery result downloads
+BQ_MAX_WORKERS = 8
+
+# Directory to cache downloaded tables in between runs, caching is off unless it is set
+TABLE_CACHE_DIR = os.environ.get("TDR2DD_CACHE_DIR")
+
+# Cached credentials and TDR API client, shared across objects
+TOKEN_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+_tdr_creds = None
+_tdr_api_client = None
+_tdr_client_lock = threading.Lock()
+
 # Function to refresh TDR API client
-def refresh_tdr_api_client():
-    creds, project = google.auth.default()
+def refresh_tdr_api_client(creds=None):
+    if creds is None:
+        creds, project = google.auth.default()
     auth_req = google.auth.transport.requests.Request()
     creds.refresh(auth_req)
     config = data_repo_client.Configuration()
@@ -27,78 +91,216 @@ def refresh_tdr_api_client():
     api_client.client_side_validation = False
     return api_client
 
+# Function to get the cached TDR API client, refreshing the token only when it is near expiry
+def get_tdr_api_client(force_refresh=False):
+    global _tdr_creds, _tdr_api_client
+    with _tdr_client_lock:
+        if _tdr_api_client is None:
+            _tdr_creds, project = google.auth.default()
+            _tdr_api_client = refresh_tdr_api_client(_tdr_creds)
+        elif force_refresh or _tdr_creds.expiry is None or _tdr_creds.expiry - datetime.datetime.utcnow() < TOKEN_REFRESH_MARGIN:
+            _tdr_creds.refresh(google.auth.transport.requests.Request())
+            _tdr_api_client.configuration.access_token = _tdr_creds.token
+        return _tdr_api_client
+
+# Function to retrieve a single dataset or snapshot from TDR
+def retrieve_object_details(object_type, object_id, datasets_api, snapshots_api):
+    print(f"Processing {object_type} = '{object_id}'...")
+    for attempt in range(2):
+        try:
+            if object_type == "dataset":
+                return datasets_api.retrieve_dataset(id=object_id, include=["SCHEMA"]).to_dict()
+            return snapshots_api.retrieve_snapshot(id=object_id).to_dict()
+        except ApiException as e:
+            if e.status != 401 or attempt:
+                raise
+            # Token was rejected, refresh it on the shared client and retry once
+            get_tdr_api_client(force_refresh=True)
+
 def extract_query_items(object_type, object_id_list, output_path):
    
     if object_type in ["dataset", "snapshot"]:
         print(f"Start time: {datetime.datetime.now()}")
         query_items = []
-         # Loop through and process listed objects
-        for object_id in object_id_list:
-
-            # Establish API client
-            api_client = refresh_tdr_api_client()
-            datasets_api = data_repo_client.DatasetsApi(api_client=api_client)
-            snapshots_api = data_repo_client.SnapshotsApi(api_client=api_client)
+        # Establish API client once; the same connection pool is reused for every object
+        api_client = get_tdr_api_client()
+        datasets_api = data_repo_client.DatasetsApi(api_client=api_client)
+        snapshots_api = data_repo_client.SnapshotsApi(api_client=api_client)
 
-            # Retrieve dataset details
-            print(f"Processing {object_type} = '{object_id}'...")
-            try:
-                if object_type == "dataset":
-                    object_details = datasets_api.retrieve_dataset(id=object_id, include=["SCHEMA"]).to_dict()
-                    object_name = object_details["name"]
-                    object_schema = object_details["schema"]["tables"]
-                else:
-                    object_details = snapshots_api.retrieve_snapshot(id=object_id).to_dict()
-                    object_name = object_details["name"]
-                    object_schema = object_details["tables"]
-                    object_project = object_details["data_project"]
-                    table_names = []
-                    tables = object_schema
-                    for table in object_schema:
-                        table_names.append(table["name"])
-                    query_items.append({"table_names": table_names,"dataset_name":object_name,"data_project":object_project})
+        # Retrieve object details concurrently, the requests are network bound
+        with ThreadPoolExecutor(max_workers=TDR_MAX_WORKERS) as executor:
+            futures = [
+                executor.submit(retrieve_object_details, object_type, object_id, datasets_api, snapshots_api)
+                for object_id in object_id_list
+            ]
+            # Loop through and process listed objects
+            for future in futures:
+                try:
+                    object_details = future.result()
+                    if object_type == "dataset":
+                        object_name = object_details["name"]
+                        object_schema = object_details["schema"]["tables"]
+                    else:
+                        object_name = object_details["name"]
+                        object_schema = object_details["tables"]
+                        object_project = object_details["data_project"]
+                        table_names = []
+                        for table in object_schema:
+                            table_names.append(table["name"])
+                        query_items.append({"table_names": table_names,"dataset_name":object_name,"data_project":object_project,"tables":object_schema})
 
-            except Exception as e:
-                print(f"Error retrieving object from TDR: {str(e)}")
-                print("Continuing to next object.")
-                continue
-        return {"query_items":query_items, "tables":tables}
+                except Exception as e:
+                    print(f"Error retrieving object from TDR: {str(e)}")
+                    print("Continuing to next object.")
+                    continue
+        return {"query_items":query_items}
                              
     else:
         print("Invalid object_type provided. Please specified 'dataset' or 'snapshot' and try again.")
 
-## Function to query dataset tables with BigQuery
-def query_dataset_tables(query_items, output_path):
+## Function to get the local cache path for a table, keyed on the table's last modification time
+def table_cache_path(bq_client, table_id, cache_dir):
+    try:
+        modified = bq_client.get_table(table_id).modified
+    except Exception as e:
+        print(f"Not caching table {table_id}: {str(e)}")
+        return None
+    key = hashlib.sha256(f"{table_id}:{modified.isoformat()}".encode()).hexdigest()
+    return os.path.join(cache_dir, f"{key}.pkl")
+
+## Function to load a table from the local cache, returning None when the entry cannot be read
+def load_cached_table(cache_path):
+    try:
+        return pd.read_pickle(cache_path)
+    except Exception as e:
+        # Truncated, or written by another pandas version, drop it so the table is queried again
+        print(f"Discarding unreadable cache entry {cache_path}: {str(e)}")
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+        return None
+
+## Function to download a BigQuery job's results and optionally save them as CSV or Parquet
+## Without a job the table is loaded from cache_path, and queried with bq_client only if that entry is unreadable
+def download_table_results(job, table_name, output_dir, bqs_client, output_format="csv", cache_path=None, bq_client=None, table_id=None):
+    df = None
+    if job is None:
+        df = load_cached_table(cache_path)
+        if df is not None:
+            print(f"Loaded {table_name} from cache {cache_path}")
+        else:
+            job = bq_client.query(f"SELECT * FROM `{table_id}`")
+    if df is None:
+        df = job.to_dataframe(bqstorage_client=bqs_client)
+        if cache_path is not None:
+            try:
+                # Write to a temporary file first so an interrupted run never leaves a partial cache entry
+                df.to_pickle(f"{cache_path}.tmp")
+                os.replace(f"{cache_path}.tmp", cache_path)
+            except Exception as e:
+                print(f"Not caching table {table_name}: {str(e)}")
+    # A failed save is reported but the DataFrame is still returned for the data dictionary
+    try:
+        if output_format == "parquet":
+            # Save the DataFrame to a typed, compressed Parquet file
+            output_file = f"{output_dir}/{table_name}.parquet"
+            df.to_parquet(output_file, engine="pyarrow", compression="snappy", index=False)
+            print(f"Query results saved to {output_file}")
+        elif output_format == "csv":
+            # Save the DataFrame to a CSV file
+            output_file = f"{output_dir}/{table_name}.csv"
+            df.to_csv(output_file, index=False)
+            print(f"Query results saved to {output_file}")
+    except Exception as e:
+        print(f"Error saving query results for {table_name}: {str(e)}")
+    return df
+
+## Function to query dataset tables with BigQuery, reusing tables cached in cache_dir when it is given
+## Yields (dataset_name, table_name, DataFrame, table schema) tuples as each download finishes, so tables are not all held in memory at once
+def query_dataset_tables(query_items, output_path, output_format="csv", cache_dir=None):
+    if output_format == "parquet" and pyarrow is None:
+        raise ValueError("Saving tables as Parquet requires pyarrow, install it or use the csv format.")
     # Initialize BigQuery client
     bq_client = bigquery.Client()
+    # Download results over the BigQuery Storage API (Arrow) when it is installed
+    bqs_client = bigquery_storage.BigQueryReadClient() if bigquery_storage is not None else None
+    if cache_dir is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError as e:
+            print(f"Not caching tables, could not create {cache_dir}: {str(e)}")
+            cache_dir = None
 
     # Loop through each query item
     for item in query_items:
         table_names = item["table_names"]
         dataset_name = item["dataset_name"]
         data_project = item["data_project"]
-        output_files = []
+        table_schemas = {table["name"]: table for table in item["tables"]}
+        table_ids = [f"{data_project}.{dataset_name}.{table_name}" for table_name in table_names]
+
+        # Look up the cache paths concurrently so the queries below are not held up by metadata round-trips
+        cache_paths = [None] * len(table_names)
+        if cache_dir is not None:
+            with ThreadPoolExecutor(max_workers=BQ_MAX_WORKERS) as executor:
+                cache_paths = list(executor.map(lambda table_id: table_cache_path(bq_client, table_id, cache_dir), table_ids))
 
-        # Loop through each table name and run a query
-        for table_name in table_names:
-            query = f"SELECT * FROM `{data_project}.{dataset_name}.{table_name}`"
+        # Submit every uncached table query up front so BigQuery runs the jobs concurrently, cached tables are loaded by the download pool
+        jobs = []
+        for table_name, table_id, cache_path in zip(table_names, table_ids, cache_paths):
             try:
-                df = bq_client.query(query).to_dataframe()
-                # Create output directory if it doesn't exist
-                output_dir = f"{output_path}/{dataset_name}/orginal_data"
-                os.makedirs(output_dir, exist_ok=True)
-                # Save the DataFrame to a CSV file
-                output_file = f"{output_dir}/{table_name}.csv"
-                df.to_csv(output_file, index=False)
-                print(f"Query results saved to {output_file}")
-                output_files.append(output_file)
+                if cache_path is not None and os.path.exists(cache_path):
+                    jobs.append((table_name, table_id, None, cache_path))
+                else:
+                    query = f"SELECT * FROM `{table_id}`"
+                    jobs.append((table_name, table_id, bq_client.query(query), cache_path))
             except Exception as e:
                 print(f"Error querying table {table_name}: {str(e)}")
-        return output_files
 
-# Function infer data types
-def infer_data_types(csv_file, tables, enumeration_threshold):
-    df = pd.read_csv(csv_file)
+        # Create output directory if it doesn't exist
+        output_dir = f"{output_path}/{dataset_name}/orginal_data"
+        if output_format is not None:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Download the job results in parallel, handing back the oldest table before starting another
+        # so at most BQ_MAX_WORKERS downloaded tables are held at once
+        with ThreadPoolExecutor(max_workers=BQ_MAX_WORKERS) as executor:
+            pending = deque()
+            for index, (table_name, table_id, job, cache_path) in enumerate(jobs):
+                pending.append((table_name, executor.submit(download_table_results, job, table_name, output_dir, bqs_client, output_format, cache_path, bq_client, table_id)))
+                last_job = index == len(jobs) - 1
+                while pending and (len(pending) == BQ_MAX_WORKERS or last_job):
+                    done_name, future = pending.popleft()
+                    try:
+                        df = future.result()
+                    except Exception as e:
+                        print(f"Error querying table {done_name}: {str(e)}")
+                        continue
+                    yield (dataset_name, done_name, df, [table_schemas[done_name]])
+
+# Function to check if a pandas dtype stores its data in Arrow arrays
+def is_arrow_backed(dtype):
+    if isinstance(dtype, pd.StringDtype):
+        # pandas < 1.3 has no storage option, its strings are always Python objects
+        return getattr(dtype, "storage", None) == "pyarrow"
+    arrow_dtype = getattr(pd, "ArrowDtype", None)
+    return arrow_dtype is not None and isinstance(dtype, arrow_dtype)
+
+# Function to count a column's distinct non-null values, also returning them when there are at most max_count
+def distinct_values(series, max_count):
+    if pyarrow is not None and is_arrow_backed(series.dtype):
+        # Arrow kernels count first, the values are only materialized for enumeration candidates
+        values = pyarrow.array(series)
+        unique_count = pc.count_distinct(values).as_py()
+        if unique_count > max_count:
+            return unique_count, None
+        return unique_count, pc.unique(pc.drop_null(values)).to_pylist()
+    unique_values = series.dropna().unique()
+    return len(unique_values), unique_values
+
+# Function infer data types from a table DataFrame or a CSV/Parquet file path
+def infer_data_types(table_data, tables, enumeration_threshold):
     data_dictionary = []
     
     # Create a mapping of column names to their schema details from `tables`
@@ -113,49 +315,90 @@ def infer_data_types(csv_file, tables, enumeration_threshold):
 
             }
 
+    # Read with the types the schema already declares so pandas does not have to sniff them
+    dtype_map = {}
+    for name, info in schema_mapping.items():
+        pandas_dtype = str if info["is_array"] else TDR_PANDAS_DTYPES.get(info["datatype"])
+        if pandas_dtype is not None:
+            dtype_map[name] = pandas_dtype
+    if isinstance(table_data, pd.DataFrame):
+        df = table_data
+    elif str(table_data).endswith(".parquet"):
+        # Parquet keeps the column types, so nothing needs to be inferred
+        df = pd.read_parquet(table_data)
+    else:
+        try:
+            df = pd.read_csv(table_data, dtype=dtype_map, engine="c", low_memory=False)
+        except (ValueError, TypeError):
+            # Values that do not fit the declared types, fall back to pandas inference
+            df = pd.read_csv(table_data, low_memory=False)
+
+    # Only non-array string columns can be enumerated, array values may not be hashable
+    enum_candidates = [
+        c for c in df.columns
+        if schema_mapping.get(c, {}).get("datatype") == "string" and not schema_mapping[c]["is_array"]
+    ]
+    # Tables downloaded from BigQuery hold strings as Python objects, convert the enumeration candidates so Arrow counts their values
+    if STRING_DTYPE is not str:
+        arrow_casts = {c: STRING_DTYPE for c in enum_candidates if not is_arrow_backed(df.dtypes[c])}
+        if arrow_casts:
+            df = df.astype(arrow_casts)
+    # Only non-array integer and float columns report a min and max
+    numeric_cols = [
+        c for c in df.columns
+        if schema_mapping.get(c, {}).get("datatype") in ("integer", "float") and not schema_mapping[c]["is_array"]
+        and pd.api.types.is_numeric_dtype(df.dtypes[c]) and not pd.api.types.is_bool_dtype(df.dtypes[c])
+    ]
+
+    # Column statistics computed for each group of columns at once
+    non_null_counts = df[enum_candidates].count()
+    # Integer and float columns are reduced separately so large integers are not upcast to float
+    int_cols = [c for c in numeric_cols if pd.api.types.is_integer_dtype(df.dtypes[c])]
+    float_cols = [c for c in numeric_cols if pd.api.types.is_float_dtype(df.dtypes[c])]
+    min_values = {**df[int_cols].min().to_dict(), **df[float_cols].min().to_dict()}
+    max_values = {**df[int_cols].max().to_dict(), **df[float_cols].max().to_dict()}
+    row_count = len(df)
+    col_dtypes = df.dtypes
+    # (datatype, is_array, is_required, description) per column, unpacked once per column below
+    schema_fields = {
+        name: (info["datatype"], info["is_array"], info["is_required"], info["description"])
+        for name, info in schema_mapping.items()
+    }
+
     for col in df.columns:
         # Basic info
         col_name = col
-        col_dtype = df[col].dtype  # Pandas-inferred data type
-        schema_info = schema_mapping.get(col_name, {})
-        schema_dtype = schema_info.get("datatype", "Unknown")
-        is_array = schema_info.get("is_array", False)
-        is_required = schema_info.get("is_required", False)
-        description = schema_info.get("description", None)
+        col_dtype = col_dtypes[col]  # Pandas-inferred data type
+        schema_dtype, is_array, is_required, description = schema_fields.get(col_name, DEFAULT_SCHEMA_FIELDS)
         type = schema_dtype  # Default to schema data type
-        enumerated_values = schema_info.get("enumerated_values", None)
         min = ''
         max = ''
         units = ''
         
         if is_array:
-            if schema_dtype == 'string':
-                type = 'array of strings'
-            elif schema_dtype == 'integer':
-                type = 'array of integers'
-            elif schema_dtype == 'float':
-                type = 'array of floats'
+            type = ARRAY_TYPES.get(schema_dtype, schema_dtype)
         
         # Count of non-null entries
-        non_null_count = df[col].count()
-        # Count of distinct values
-        unique_count = df[col].nunique(dropna=True)
+        non_null_count = non_null_counts.get(col, 0)
+        # Distinct values, computed once and reused for the enumeration
+        unique_values = None
+        unique_count = 0
+        if col in non_null_counts.index:
+            unique_count, unique_values = distinct_values(df[col], non_null_count * (enumeration_threshold / 100))
         # Check if unique count is 50% or less of the total non-null count        
-        if unique_count < len(df[col]) and not is_array and type == 'string' and unique_count <= non_null_count * (enumeration_threshold / 100):
-            enumerated_values = df[col].unique().tolist()
-            enumerated_values = ";".join([f"{item}" for item in enumerated_values])
-        elif type == 'boolean':
-            enumerated_values = 'T=True;F=False'
+        if unique_count < row_count and not is_array and type == 'string' and unique_count <= non_null_count * (enumeration_threshold / 100):
+            enumerated_values = ";".join(map(str, unique_values))
         else:
-            enumerated_values = None
+            enumerated_values = FIXED_ENUMERATIONS.get(type)
         if type == 'integer' or type == 'float':
             # Get min and max values
-            if df[col].dtype == 'int64':
-                min = int(df[col].min())
-                max = int(df[col].max())
-            elif df[col].dtype == 'float64':
-                min = float(df[col].min())
-                max = float(df[col].max())
+            if col in min_values and pd.notna(min_values[col]):
+                if pd.api.types.is_integer_dtype(col_dtype):
+                    min = int(min_values[col])
+                    max = int(max_values[col])
+                elif pd.api.types.is_float_dtype(col_dtype):
+                    min = float(min_values[col])
+                    max = float(max_values[col])
         
         # Construct a row for this column
         col_info = {
@@ -173,33 +416,42 @@ def infer_data_types(csv_file, tables, enumeration_threshold):
     data_dict_df = pd.DataFrame(data_dictionary)
     return data_dict_df  # Return the DataFrame instead of printing it
 
-def main(object_id_list, study_dir, enumeration_threshold):
+def main(object_id_list, study_dir, enumeration_threshold, original_data_format="csv", table_cache_dir=TABLE_CACHE_DIR):
     object_type = "snapshot"
     output_path = study_dir
     dataset_items = extract_query_items(object_type, object_id_list, output_path)
     query_items = dataset_items["query_items"]
-    tables = dataset_items["tables"]
-    working_csvs = query_dataset_tables(query_items, output_path)
+    # Snapshots of the same study often share table names, those dictionaries are saved under their dataset's directory
+    table_name_counts = Counter(table_name for item in query_items for table_name in item["table_names"])
     
-    for csv_file in working_csvs:
-        print(f"Inferring data types for {csv_file}...")
-        base_name = os.path.splitext(os.path.basename(csv_file))[0]
-        dict_file = os.path.join(output_path, f"{base_name}_data_dict.csv")
-        data_dict_df = infer_data_types(csv_file, tables, enumeration_threshold)
+    # Each data dictionary is written as soon as its table is downloaded, so only a few tables are in memory at a time
+    for dataset_name, table_name, df, tables in query_dataset_tables(query_items, output_path, original_data_format, table_cache_dir):
+        print(f"Inferring data types for {table_name}...")
+        dict_dir = output_path
+        if table_name_counts[table_name] > 1:
+            dict_dir = os.path.join(output_path, dataset_name)
+            os.makedirs(dict_dir, exist_ok=True)
+        dict_file = os.path.join(dict_dir, f"{table_name}_data_dict.csv")
+        data_dict_df = infer_data_types(df, tables, enumeration_threshold)
         if data_dict_df is not None:
             data_dict_df.to_csv(dict_file, index=False)
             print(f"Data dictionary saved to {dict_file}")
         else:
-            print(f"Failed to infer data types for {csv_file}")
+            print(f"Failed to infer data types for {table_name}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process TDR objects.')
     parser.add_argument('--object_ids', nargs='+', required=True, help='List of object IDs to process')
     parser.add_argument('--study_dir', required=True, help='Directory to save the study files')
     parser.add_argument('--enumeration_threshold', required=True, type=int, help='percentage (integer, so x 100) of unique values to be considered enumerated')
+    parser.add_argument('--original_data_format', choices=['csv', 'parquet', 'none'], default='csv', help='Format to save the queried tables in (parquet requires pyarrow), or none to skip saving them')
+    parser.add_argument('--table_cache_dir', default=TABLE_CACHE_DIR, help='Directory to cache downloaded tables in between runs (defaults to $TDR2DD_CACHE_DIR, tables are not cached when neither is set)')
     args = parser.parse_args()
+    if args.original_data_format == 'parquet' and pyarrow is None:
+        parser.error("--original_data_format parquet requires pyarrow, install it or use csv")
     object_id_list = args.object_ids
     study_dir = args.study_dir
     enumeration_threshold = args.enumeration_threshold or 30
-    main(object_id_list, study_dir, enumeration_threshold)
+    original_data_format = None if args.original_data_format == 'none' else args.original_data_format
+    main(object_id_list, study_dir, enumeration_threshold, original_data_format, args.table_cache_dir)
 